@@ -0,0 +1,165 @@
+"""
+OpenAI side of the ED Copilot demo: cached client, the rolling
+conversation summary, and the streamed answer generator.
+"""
+
+import httpx
+import streamlit as st
+import tiktoken
+from openai import OpenAI
+
+@st.cache_resource
+def _openai() -> OpenAI:
+    # Generous read limit for streamed completions, but connect failures
+    # surface in seconds instead of wedging the Streamlit rerun.
+    return OpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        max_retries=2,
+    )
+
+@st.cache_resource
+def _encoder():
+    try:
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """Trim text to at most `budget` tokens of the answer model's encoding."""
+    enc = _encoder()
+    toks = enc.encode(text)
+    if len(toks) <= budget:
+        return text
+    return enc.decode(toks[:budget]).rstrip()
+
+def warm_openai():
+    """
+    Prime the cached client's keep-alive connection (TLS handshake, pool
+    slot) so the first completion token isn't waiting on setup. The
+    response is discarded; failures just mean the real call pays setup.
+    """
+    try:
+        _openai().models.list()
+    except Exception:
+        pass
+
+def update_conversation_summary(prev_summary: str, question: str, answer: str) -> str:
+    """
+    Roll the running conversation summary forward over the latest turn.
+    Sending a <=120-token summary instead of raw prior turns keeps prefill
+    size (and per-turn latency) flat no matter how long the chat runs.
+    """
+    parts = []
+    if prev_summary:
+        parts.append(f"Summary so far: {prev_summary}")
+    parts.append(f"Clinician asked: {question}")
+    parts.append(f"Assistant answered: {answer}")
+
+    resp = _openai().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "Summarize this ED copilot conversation in at most 120 tokens, "
+                    "preserving clinical specifics (complaints, key findings, "
+                    "decisions, cited PMIDs). Output only the summary."
+                ),
+            },
+            {"role": "user", "content": "\n\n".join(parts)},
+        ],
+        temperature=0.0,
+        max_tokens=160,
+    )
+    return (resp.choices[0].message.content or "").strip()
+
+# Static system prompt, interned once at import. Keeping it byte-identical
+# across calls also positions it for provider-side prompt caching.
+SYSTEM_PROMPT = (
+    "You are an emergency medicine attending helping another ED clinician on shift. "
+    "Be concise and practical. "
+    "Do not ask for or include PHI. "
+    "Use only the provided PubMed metadata/abstracts for evidence. "
+    "If abstracts are not provided, explicitly note that evidence grounding is limited. "
+    "If critical details are missing, ask up to 3 clarifying questions first, then give a best-effort answer. "
+    "Only cite PMIDs that appear in Allowed PMIDs. "
+    "If Allowed PMIDs is not 'none', you MUST cite at least 1 PMID from it."
+)
+
+# Completed (answer, rolled-forward summary) pairs keyed on everything that
+# shapes the prompt, so a rerun or re-click with identical inputs re-renders
+# for free — including the conversation summary — instead of paying another
+# API call. A plain dict (not st.cache_data) because cache misses return a
+# live token stream, which Streamlit's cache cannot replay.
+_ANSWER_CACHE = {}
+_ANSWER_CACHE_MAX = 128
+
+def answer_cache_key(convo_summary, question, meta_context, allowed_pmids, mode):
+    return (convo_summary, question, meta_context, tuple(allowed_pmids), mode)
+
+def cached_answer(key):
+    return _ANSWER_CACHE.get(key)
+
+def store_answer(key, answer):
+    if key not in _ANSWER_CACHE and len(_ANSWER_CACHE) >= _ANSWER_CACHE_MAX:
+        _ANSWER_CACHE.pop(next(iter(_ANSWER_CACHE)))
+    _ANSWER_CACHE[key] = answer
+
+def generate_answer(convo_summary: str, question: str, meta_context: str, allowed_pmids, mode: str):
+    client = _openai()
+    allowed_str = ", ".join(allowed_pmids) if allowed_pmids else "none"
+
+    pmid_rule = (
+        f"Allowed PMIDs: {allowed_str}\n"
+        "RULE: If Allowed PMIDs is not 'none', end with 'Citations: ' followed by 1–3 PMIDs from Allowed PMIDs.\n"
+        "Do not write 'none' if Allowed PMIDs is not 'none'.\n"
+    )
+
+    if mode == "Discharge instructions (patient-friendly)":
+        user = f"""User question:
+{question}
+
+PubMed results (metadata{' + abstracts' if 'Abstract (truncated):' in meta_context else ''}):
+{meta_context}
+
+{pmid_rule}
+
+Write patient-friendly discharge instructions at about an 8th-grade reading level.
+Include: brief explanation, what to do at home, meds if relevant (general), red flags to return, follow-up.
+Keep it brief.
+End with: "This is not medical advice and is for demo only."
+"""
+        max_tokens = 350
+    else:
+        user = f"""User question:
+{question}
+
+PubMed results (metadata{' + abstracts' if 'Abstract (truncated):' in meta_context else ''}):
+{meta_context}
+
+{pmid_rule}
+
+Output (keep brief):
+- Quick take (max 3 bullets)
+- Workup (labs/imaging) (max 6 bullets)
+- Treatment (max 6 bullets)
+- Disposition (max 4 bullets)
+- Citations: 1–3 PMIDs (required if Allowed PMIDs is not 'none')
+"""
+        max_tokens = 450
+
+    convo = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if convo_summary:
+        convo.append({"role": "system", "content": f"Conversation so far: {convo_summary}"})
+    convo.append({"role": "user", "content": user})
+
+    resp = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=convo,
+        temperature=0.2,
+        max_tokens=max_tokens,
+        stream=True,
+    )
+    # Generator of text deltas for st.write_stream.
+    return (c.choices[0].delta.content or "" for c in resp if c.choices)
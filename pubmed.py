@@ -0,0 +1,451 @@
+"""
+PubMed E-utilities access for the ED Copilot demo: query normalization,
+search with progressive relaxation, the coalesced article fetcher, and
+evidence-context assembly. UI-free so any app variant shares one cache
+namespace and connection pool.
+"""
+
+import asyncio
+import re
+import threading
+import time
+from functools import lru_cache
+from io import BytesIO
+from typing import NamedTuple
+
+import aiohttp
+import orjson
+import streamlit as st
+from lxml import etree
+
+from llm import truncate_to_tokens
+
+NCBI_ESEARCH = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
+NCBI_EFETCH = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+
+NCBI_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class Hit(NamedTuple):
+    """One PubMed result; lighter and faster to read field-wise than a dict."""
+    pmid: str
+    title: str
+    journal: str
+    year: str
+    url: str
+
+def _ncbi_params(**params):
+    """
+    Common E-utilities params. tool/email identify us so NCBI applies the
+    friendlier throttling tier; an api_key raises the rate ceiling from
+    3 to 10 req/s, which the concurrent fetch paths rely on.
+    """
+    params["tool"] = "ed-copilot"
+    email = st.secrets.get("NCBI_EMAIL", "")
+    if email:
+        params["email"] = email
+    api_key = st.secrets.get("NCBI_API_KEY", "")
+    if api_key:
+        params["api_key"] = api_key
+    return params
+
+async def _ncbi_get(session, url, params, retries=3, backoff=0.3):
+    """
+    GET with exponential backoff on NCBI's occasional 429/5xx so transient
+    throttling doesn't surface as a user-visible error. Returns raw bytes.
+    """
+    for attempt in range(retries + 1):
+        async with session.get(url, params=params) as r:
+            if r.status not in NCBI_RETRY_STATUSES or attempt == retries:
+                r.raise_for_status()
+                return await r.read()
+        await asyncio.sleep(backoff * (2 ** attempt))
+
+class _NcbiClient:
+    """
+    One long-lived aiohttp session on a dedicated background event loop, so
+    TLS handshakes and connections are paid once per process instead of once
+    per asyncio.run. Sync callers submit coroutines via run().
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self.session = self.run(self._make_session())
+
+    @staticmethod
+    async def _make_session():
+        # Separate connect/read limits fail fast on a slow NCBI node instead
+        # of letting one TCP stall eat the whole per-request budget.
+        return aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=25, connect=3.05, sock_read=10),
+            connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=30),
+            headers={"Accept-Encoding": "gzip"},
+        )
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+@st.cache_resource
+def _ncbi_client() -> _NcbiClient:
+    return _NcbiClient()
+
+STOPWORDS = frozenset({
+    "adult","peds","pediatric","initial","management","workup","labs","lab","treatment","treatments",
+    "criteria","admission","disposition","dx","ddx","ed","em","er","the","a","an","and","or","to",
+    "for","of","with","without","in","on","at","by","from","vs","versus","suspected","possible",
+    "patient","patients","male","female","man","woman","yo","y/o","year","old","criteria","consider",
+    "how","what","when","why","should","could","would","can","do","does","did","best","ways","way",
+    "manage","management","treat","treatment","workup","evaluation","approach"
+})
+
+SYNONYMS = {
+    "dka": "diabetic ketoacidosis",
+    "pe": "pulmonary embolism",
+    "acs": "acute coronary syndrome",
+    "ich": "intracerebral hemorrhage",
+    "tbi": "traumatic brain injury",
+    "uti": "urinary tract infection",
+    "copd": "chronic obstructive pulmonary disease",
+    "afib": "atrial fibrillation",
+    "rvr": "rapid ventricular response",
+}
+
+# Compiled once: a single alternation pass beats one re.sub per synonym.
+_SYN_RE = re.compile(r"\b(" + "|".join(map(re.escape, SYNONYMS)) + r")\b")
+_PMID_RE = re.compile(r"\b\d{7,8}\b")
+_TOKEN_RE = re.compile(r"[A-Za-z0-9]+")
+_TIAB_RE = re.compile(r"\[Title/Abstract\]")
+
+@lru_cache(maxsize=256)
+def make_pubmed_term(q: str) -> str:
+    """
+    Produces a reasonable first-pass PubMed query for natural language.
+    We avoid quoting the full question because that almost always kills recall.
+    """
+    q = (q or "").strip()
+    if not q:
+        return ""
+
+    raw = _SYN_RE.sub(lambda m: SYNONYMS[m.group(1)], q.lower())
+    # One findall pass tokenizes and strips punctuation together;
+    # dict.fromkeys is an order-preserving dedup in one C-level pass.
+    key = list(dict.fromkeys(t for t in _TOKEN_RE.findall(raw) if t not in STOPWORDS))[:6]
+
+    # Prefer OR across key terms in title/abstract, let PubMed do its own mapping too.
+    # Example: (chest[tiab] OR pain[tiab] OR troponin[tiab]) OR (chest pain troponin)
+    if key:
+        tiab_or = " OR ".join([f"{t}[tiab]" for t in key])
+        raw_fallback = " ".join(key)
+        return f"({tiab_or}) OR ({raw_fallback})"
+
+    # Nothing survived stopword removal; signal the caller to skip the search.
+    return ""
+
+async def _pubmed_search(session, term: str, retmax: int = 5):
+    """
+    Progressive relaxation so natural language questions still get hits.
+    """
+    q = (term or "").strip()
+    if not q:
+        return []
+
+    cooked = make_pubmed_term(q)
+    if not cooked:
+        # Stopwords-only question: no candidate would do better than noise,
+        # so don't spend an NCBI round-trip on it.
+        return []
+
+    candidates = [
+        cooked,                                  # structured-ish
+        cooked.replace(" AND ", " OR "),         # (in case any ANDs slip in)
+        _TIAB_RE.sub("[tiab]", cooked),
+        " ".join(_TOKEN_RE.findall(q)[:8]),  # raw-ish keywords, PubMed translation helps
+        q,                                       # absolute fallback: raw question
+    ]
+    candidates = list(dict.fromkeys(t.strip() for t in candidates if t and t.strip()))
+
+    # Fire every candidate at once and accept in priority order: worst-case
+    # latency is max(candidates) instead of their sum.
+    results = await asyncio.gather(
+        *(_esearch_ids(session, t, retmax) for t in candidates),
+        return_exceptions=True,
+    )
+
+    for ids in results:
+        if not isinstance(ids, BaseException) and ids:
+            return ids
+
+    if results and all(isinstance(r, BaseException) for r in results):
+        raise results[0]
+
+    return []
+
+async def _esearch_ids(session, term, retmax):
+    body = await _ncbi_get(
+        session,
+        NCBI_ESEARCH,
+        _ncbi_params(
+            db="pubmed",
+            term=term,
+            retmode="json",
+            retmax=retmax,
+            sort="relevance",
+        ),
+    )
+    result = orjson.loads(body).get("esearchresult")
+    return result.get("idlist", []) if result else []
+
+def _parse_articles(body):
+    """Pure parser: EFetch XML bytes -> ({pmid: Hit}, {pmid: abstract_text})."""
+    hits = {}
+    abstracts = {}
+
+    # iterparse (libxml2) handles one article at a time instead of building
+    # the whole DOM for a multi-article payload.
+    for _, article in etree.iterparse(BytesIO(body), tag="PubmedArticle"):
+        pmid_el = article.find(".//MedlineCitation/PMID")
+        pmid = (pmid_el.text or "").strip() if pmid_el is not None else ""
+
+        if pmid:
+            title_el = article.find(".//Article/ArticleTitle")
+            title = "".join(title_el.itertext()).strip().rstrip(".") if title_el is not None else ""
+
+            journal_el = article.find(".//Article/Journal/Title")
+            journal = (journal_el.text or "").strip() if journal_el is not None else ""
+
+            year_el = article.find(".//Article/Journal/JournalIssue/PubDate/Year")
+            if year_el is not None:
+                year = (year_el.text or "").strip()
+            else:
+                md_el = article.find(".//Article/Journal/JournalIssue/PubDate/MedlineDate")
+                year = (md_el.text or "").strip()[:4] if md_el is not None else ""
+
+            hits[pmid] = Hit(
+                pmid=pmid,
+                title=title,
+                journal=journal,
+                year=year,
+                url=f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/",
+            )
+
+            abs_parts = []
+            for a in article.findall(".//Abstract/AbstractText"):
+                label = a.attrib.get("Label")
+                txt = "".join(a.itertext()).strip()
+                if not txt:
+                    continue
+                abs_parts.append(f"{label}: {txt}" if label else txt)
+
+            if abs_parts:
+                abstracts[pmid] = "\n".join(abs_parts)
+
+        article.clear()
+        # Drop already-processed siblings too, so peak memory stays at
+        # O(one article) rather than O(payload).
+        while article.getprevious() is not None:
+            del article.getparent()[0]
+
+    return hits, abstracts
+
+class _ArticleBatcher:
+    """
+    Coalesces EFetch requests from concurrent sessions into one call.
+    NCBI accepts hundreds of IDs per EFetch, so under load N round-trips
+    collapse to 1, at the cost of up to `window` seconds of added latency.
+    Thread-based because the callers are synchronous script threads; the
+    actual I/O runs on the shared _NcbiClient loop.
+    """
+
+    def __init__(self, window: float = 0.1):
+        self._window = window
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def fetch(self, pmids):
+        """Blocking; returns ({pmid: Hit}, {pmid: abstract}) for the requested IDs."""
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = {
+                    "pmids": [],
+                    "done": threading.Event(),
+                    "hits": {},
+                    "abstracts": {},
+                    "error": None,
+                }
+            batch["pmids"].extend(pmids)
+
+        if leader:
+            time.sleep(self._window)
+            with self._lock:
+                self._batch = None
+            try:
+                union = list(dict.fromkeys(batch["pmids"]))
+                batch["hits"], batch["abstracts"] = self._fetch_union(union)
+            except BaseException as e:
+                batch["error"] = e
+                raise
+            finally:
+                batch["done"].set()
+        else:
+            # The leader's failure is every follower's failure; returning
+            # empty results here would masquerade as "no articles found".
+            if not batch["done"].wait(timeout=60):
+                raise TimeoutError("timed out waiting for the batched EFetch")
+            if batch["error"] is not None:
+                raise batch["error"]
+
+        hits, abstracts = batch["hits"], batch["abstracts"]
+        return (
+            {p: hits[p] for p in pmids if p in hits},
+            {p: abstracts[p] for p in pmids if p in abstracts},
+        )
+
+    def _fetch_union(self, pmids):
+        client = _ncbi_client()
+        body = client.run(
+            _ncbi_get(
+                client.session,
+                NCBI_EFETCH,
+                _ncbi_params(db="pubmed", id=",".join(pmids), retmode="xml"),
+            )
+        )
+        return _parse_articles(body)
+
+_ARTICLE_BATCHER = _ArticleBatcher()
+
+@st.cache_data(ttl=24 * 60 * 60, max_entries=256, persist="disk", show_spinner=False)
+def pubmed_bundle(pmids: tuple):
+    """
+    Summaries + abstracts for a PMID set, one NCBI round-trip: EFetch XML
+    already carries title/journal/year alongside the abstracts, so the
+    separate esummary call is gone. Keyed on the PMID tuple so different
+    questions that resolve to the same articles share a cache entry.
+    """
+    if not pmids:
+        return [], {}
+    hits, abstracts = _ARTICLE_BATCHER.fetch(list(pmids))
+    if not hits:
+        # Exceptions are not memoized, so a transient empty payload retries
+        # on the next run instead of poisoning the disk cache for a day.
+        raise RuntimeError(f"EFetch returned no articles for {len(pmids)} PMIDs")
+    return [hits[p] for p in pmids if p in hits], abstracts
+
+# Stale-while-revalidate cache for searches: serve cached PMID lists
+# instantly, refresh in the background once past the soft TTL, and only
+# fetch synchronously past the hard TTL. Repeat demos never pay cold-cache
+# latency, but results also never go a day stale.
+_LOOKUP_SOFT_TTL = 10 * 60
+_LOOKUP_HARD_TTL = 24 * 60 * 60
+_LOOKUP_MAX_ENTRIES = 256
+_LOOKUP_CACHE = {}
+_LOOKUP_LOCK = threading.Lock()
+_LOOKUP_REFRESHING = set()
+
+def _lookup_fresh(key, q, retmax):
+    client = _ncbi_client()
+    payload = client.run(_pubmed_search(client.session, q, retmax))
+    with _LOOKUP_LOCK:
+        if key not in _LOOKUP_CACHE and len(_LOOKUP_CACHE) >= _LOOKUP_MAX_ENTRIES:
+            # Evict the stalest entry so distinct free-text queries can't
+            # grow the cache without bound.
+            del _LOOKUP_CACHE[min(_LOOKUP_CACHE, key=lambda k: _LOOKUP_CACHE[k][0])]
+        _LOOKUP_CACHE[key] = (time.time(), payload)
+    return payload
+
+def _refresh_lookup(key, q, retmax):
+    try:
+        _lookup_fresh(key, q, retmax)
+    except Exception:
+        pass  # keep serving the stale entry; next request retries
+    finally:
+        with _LOOKUP_LOCK:
+            _LOOKUP_REFRESHING.discard(key)
+
+def _search_pmids(q: str, cooked: str, retmax: int):
+    # Keyed on the cooked term so variants like "DKA management" and "dka"
+    # collapse into one entry.
+    key = (cooked, retmax)
+    with _LOOKUP_LOCK:
+        cached = _LOOKUP_CACHE.get(key)
+
+    if cached:
+        ts, payload = cached
+        age = time.time() - ts
+        if age < _LOOKUP_SOFT_TTL:
+            return payload
+        if age < _LOOKUP_HARD_TTL:
+            with _LOOKUP_LOCK:
+                kick = key not in _LOOKUP_REFRESHING
+                if kick:
+                    _LOOKUP_REFRESHING.add(key)
+            if kick:
+                threading.Thread(target=_refresh_lookup, args=(key, q, retmax), daemon=True).start()
+            return payload
+
+    return _lookup_fresh(key, q, retmax)
+
+@st.cache_data(ttl=24 * 60 * 60, max_entries=256, show_spinner=False)
+def _context_for(pmids: tuple, include_abstracts: bool, max_items: int):
+    hits, abstracts = pubmed_bundle(pmids)
+    return build_metadata_context(
+        hits,
+        abstracts=abstracts if include_abstracts else None,
+        max_items=max_items,
+    )
+
+def pubmed_lookup(q: str, retmax: int = 5, include_abstracts: bool = False):
+    """
+    Full retrieval payload for a question: hits and abstracts for display
+    plus the ready-made evidence context for the prompt, so callers never
+    re-walk the hit list and re-renders stay fully memoized.
+    """
+    q = (q or "").strip()
+    cooked = make_pubmed_term(q) if q else ""
+    if not cooked:
+        return {"hits": [], "abstracts": {}, "context": "No PubMed results returned.", "pmids": []}
+
+    # The UI caps at 10; clamp programmatic callers to E-utilities' safe
+    # single-request batch window (the downstream EFetch is one comma-joined
+    # call, so one search stays one round-trip regardless of retmax).
+    retmax = min(retmax, 200)
+
+    pmids = tuple(_search_pmids(q, cooked, retmax))
+    hits, abstracts = pubmed_bundle(pmids)
+    context, allowed_pmids = _context_for(pmids, include_abstracts, retmax)
+    return {"hits": hits, "abstracts": abstracts, "context": context, "pmids": allowed_pmids}
+
+def cited_pmids(answer: str, allowed):
+    """
+    PMIDs cited in an answer, restricted to the allowed (retrieved) set and
+    in order of first mention. Stops scanning once every allowed PMID has
+    been seen.
+    """
+    allowed = set(allowed)
+    cited = []
+    if allowed:
+        for m in _PMID_RE.finditer(answer):
+            p = m.group()
+            if p in allowed and p not in cited:
+                cited.append(p)
+                if len(cited) == len(allowed):
+                    break
+    return cited
+
+_HIT_FMT = "- {title} ({journal}, {year}). PMID {pmid}. {url}".format
+
+def _hit_line(h, abstracts, abstract_tokens):
+    line = _HIT_FMT(**h._asdict())
+    ab = (abstracts.get(h.pmid) or "").strip()
+    if ab:
+        # Budget tokens, not characters: what the prompt actually pays for.
+        ab = truncate_to_tokens(ab, abstract_tokens)
+        line += f"\n  Abstract (truncated): {ab}"
+    return line
+
+def build_metadata_context(summaries, abstracts=None, max_items=5, abstract_tokens=220):
+    use = summaries[:max_items]
+    abstracts = abstracts or {}
+    text = "\n".join(_hit_line(h, abstracts, abstract_tokens) for h in use)
+    return text or "No PubMed results returned.", [h.pmid for h in use]